@@ -1,20 +1,28 @@
 # app.py
 import csv
+import codecs
+import gzip
 import io
 import os
 import re
 import json
+import time
 import secrets
-import random
 import string
 import unicodedata
 from datetime import datetime
-from typing import List, Tuple, Optional
-from threading import Thread
-from queue import Queue, Empty
+from urllib.parse import urlencode
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, Optional
+from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from queue import Queue
 
 import requests
-from flask import Flask, request, jsonify, send_file, render_template, Response, stream_with_context
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from dotenv import load_dotenv
 
 # Load .env (expects MOODLE_URL and MOODLE_TOKEN)
@@ -36,7 +44,30 @@ WS_ENROL_MANUAL          = "enrol_manual_enrol_users"
 WS_UPDATE_USERS          = "core_user_update_users"
 
 AUTO_FIX_USERNAME_DUPLICATES = True
+USERNAME_PREFETCH_SUFFIXES = 3   # base + next N numeric suffixes are checked on Moodle in one go
+WS_VALUES_CHUNK = 200            # max values[i] per core_user_get_users_by_field call
+USER_CACHE_TTL = int(os.environ.get("MOODLE_USER_CACHE_TTL", "300"))  # seconds; lookups shared across jobs
+WS_CREATE_CHUNK = 50             # max users[i] per core_user_create_users call
+WS_ENROL_CHUNK = 100             # max enrolments[i] per enrol_manual_enrol_users call
 MOODLE_ROLE_ID = int(os.environ.get("MOODLE_ROLE_ID", "5"))  # Student
+MAX_WORKERS = int(os.environ.get("MOODLE_MAX_WORKERS", "8"))  # pool for per-user calls (unsuspend, enrolled courses), shared by all jobs
+MAX_JOBS = int(os.environ.get("MOODLE_MAX_JOBS", "4"))        # jobs processed at once; the rest wait their turn
+PIPELINE_WORKERS = max(1, int(os.environ.get("MOODLE_STAGE_WORKERS", "2")))  # threads per create/enrol stage
+
+# Responses are already gzip-negotiated by requests. Compressing request bodies needs the web
+# server to inflate them (e.g. nginx/Apache input filter), so it's opt-in.
+MOODLE_GZIP_REQUESTS = os.environ.get("MOODLE_GZIP_REQUESTS", "0") == "1"
+GZIP_MIN_BYTES = 8 * 1024  # smaller bodies aren't worth compressing
+
+# One pooled, keep-alive session for all Moodle calls (avoids a TCP+TLS handshake per request).
+# Retry's default allowed_methods excludes POST, so status-based retries never replay a create/enrol.
+# The pool keeps a connection for every thread that can call Moodle at once: the check, create and
+# enrol stages of each running job plus the shared WS_EXECUTOR (and a little headroom for /api/ping).
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=MAX_JOBS * (1 + 2 * PIPELINE_WORKERS) + MAX_WORKERS + 2,
+                       max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]))
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
 
 # CSV/table columns (unchanged)
 FIELDNAMES = [
@@ -50,13 +81,18 @@ FIELDNAMES = [
 # Helpers: names / csv
 # ---------------------------------------------------------------------
 import unicodedata
+_ASCII_NON_ALNUM = str.maketrans("", "", "".join(chr(c) for c in range(128) if not chr(c).isalnum()))
+_NON_ALPHA_RE = re.compile(r"[^a-z]")
+
 def remove_diacritics(s: str) -> str:
-    s = unicodedata.normalize("NFD", s or "")
+    s = s or ""
+    if s.isascii(): return s  # nothing to decompose
+    s = unicodedata.normalize("NFD", s)
     return "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
 
 def ascii_slug(s: str) -> str:
     s = remove_diacritics(s).lower()
-    return "".join(ch for ch in s if ch.isalnum())
+    return s.encode("ascii", "ignore").decode("ascii").translate(_ASCII_NON_ALNUM)
 
 def cap_words(s: str) -> str:
     s = (s or "").strip().lower()
@@ -73,32 +109,41 @@ def apply_replacements(text: str) -> str:
 def clean_email(s: str) -> str:
     return (s or "").replace(" ", "").strip().strip("\"'").lower()
 
-def normalize_row_keys(row: dict) -> dict:
+def resolve_columns(keys) -> Tuple[str, str, str, Optional[str]]:
+    """Map a CSV header onto (first name, last name, email, course ids) source keys."""
     def norm(k: str) -> str:
-        k = (k or "").replace("\ufeff", "").strip().lower()
-        return "".join(ch for ch in k if ch.isalpha())  # "first_name" -> "firstname"
-    m = {norm(k): k for k in row.keys()}
+        return _NON_ALPHA_RE.sub("", (k or "").lower())  # "first_name" -> "firstname"
+    m = {norm(k): k for k in keys}
     fnkey = next((m[c] for c in ("firstname","givenname","forename","first") if c in m), None)
     lnkey = next((m[c] for c in ("lastname","surname","familyname","last") if c in m), None)
     emkey = next((m[c] for c in ("emailaddress","email","mail","emailid","emailaddr","eaddress") if c in m), None)
     cikey = next((m[c] for c in ("courseids","courseid","course") if c in m), None)  # optional
     if not fnkey or not lnkey or not emkey:
-        found = ", ".join(row.keys())
+        found = ", ".join(keys)
         raise ValueError(
             "Missing required columns. Expected at least "
             "'First Name', 'Last Name', 'Email Address'. "
             f"Found: {found}"
         )
+    return fnkey, lnkey, emkey, cikey
+
+def normalize_row_keys(row: dict, columns: Optional[Tuple[str, str, str, Optional[str]]] = None) -> dict:
+    fnkey, lnkey, emkey, cikey = columns or resolve_columns(row.keys())
     out = {"First Name": row[fnkey], "Last Name": row[lnkey], "Email Address": row[emkey]}
     if cikey: out["Course IDs"] = str(row[cikey])
     return out
 
-def make_usernames(rows: List[dict]) -> List[dict]:
-    out, counts, used = [], {}, set()
+def make_usernames(rows: Iterable[dict]) -> Iterator[dict]:
+    """Lazily yield cleaned rows with generated usernames (rows may be a streaming reader)."""
+    counts, used = {}, set()
+    keys, columns = None, None
     for r in rows:
         if not r or all((str(v or "").strip() == "") for v in r.values()):
             continue
-        base_row = normalize_row_keys(r)
+        if columns is None or r.keys() != keys:
+            # CSV rows share one header, so the column mapping is resolved once
+            keys, columns = r.keys(), resolve_columns(r.keys())
+        base_row = normalize_row_keys(r, columns)
         first = cap_words(base_row["First Name"])
         last  = cap_words(base_row["Last Name"])
         email = clean_email(base_row["Email Address"])
@@ -107,66 +152,120 @@ def make_usernames(rows: List[dict]) -> List[dict]:
         base = ascii_slug(username_source) or ascii_slug(email.split("@")[0]) or "user"
         suffix = counts.get(base, 0)
         candidate = base if suffix == 0 else f"{base}{suffix}"
-        while candidate in used:
+        while candidate in used:  # safety net, e.g. base "ali1" colliding with "ali" + suffix 1
             suffix += 1
             candidate = f"{base}{suffix}"
-        counts[base] = suffix
+        counts[base] = suffix + 1  # next free suffix, so later duplicates don't rescan
         used.add(candidate)
-        out.append({
+        yield {
             "First Name": first, "Last Name": last, "Email Address": email,
             "Username": candidate, "Password": "",
             "Course IDs": course_ids,
             "Status": "", "Enrol Status": "", "Suspend Status": "",
             "Existing First Name":"", "Existing Last Name":"", "Existing Username":"",
             "Existing Email":"", "Existing ID":""
-        })
-    return out
+        }
+
+CSV_FLUSH_BYTES = 64 * 1024  # download chunk size
 
-def rows_to_csv_bytes(rows: List[dict]) -> bytes:
+def iter_csv_bytes(rows: Iterable[dict]) -> Iterator[bytes]:
+    """Yield the CSV in chunks, reusing one small buffer instead of building the whole file."""
     buf = io.StringIO()
     writer = csv.DictWriter(buf, fieldnames=FIELDNAMES, extrasaction="ignore")
+    yield "\ufeff".encode("utf-8")  # BOM for Excel
     writer.writeheader()
-    for r in rows: writer.writerow(r)
-    return ("\ufeff" + buf.getvalue()).encode("utf-8")  # BOM for Excel
+    for r in rows:
+        writer.writerow(r)
+        if buf.tell() >= CSV_FLUSH_BYTES:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode("utf-8")
 
 # ---------------------------------------------------------------------
 # Validation & Moodle helpers
 # ---------------------------------------------------------------------
 EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+USERNAME_RE = re.compile(r"[a-z0-9._-]+")
+_DIGITS_RE = re.compile(r"\d+")
 
-def validate_row(u: dict) -> Optional[str]:
+def validate_row(u: dict) -> Tuple[Optional[str], Tuple[str, str, str, str]]:
+    """Return (error or None, (username, first, last, email)) with the fields stripped/lowercased once."""
     un = (u.get("Username") or "").strip().lower()
     fn = (u.get("First Name") or "").strip()
     ln = (u.get("Last Name") or "").strip()
     em = (u.get("Email Address") or "").strip().lower()
-    if not un or not fn or not ln or not em: return "Missing required field(s)"
-    if not EMAIL_RE.match(em): return "Invalid email format"
-    if len(un) > 100: return "Username too long (>100)"
-    if not re.fullmatch(r"[a-z0-9._-]+", un): return "Username has disallowed characters"
-    return None
+    fields = (un, fn, ln, em)
+    if not un or not fn or not ln or not em: return "Missing required field(s)", fields
+    if not EMAIL_RE.match(em): return "Invalid email format", fields
+    if len(un) > 100: return "Username too long (>100)", fields
+    # Generated usernames are plain [a-z0-9]; two C-level str checks cover them before the regex
+    if not (un.isascii() and un.isalnum()) and not USERNAME_RE.fullmatch(un):
+        return "Username has disallowed characters", fields
+    return None, fields
+
+PASSWORD_SPECIALS = "!@#$%^&*()-_=+[]{}"
+PASSWORD_ALPHABET = string.ascii_letters + string.digits + PASSWORD_SPECIALS
+PASSWORD_LENGTH = 16
+_PASSWORD_BYTE_LIMIT = 256 - 256 % len(PASSWORD_ALPHABET)  # bytes at/above this would bias the modulo
+_PASSWORD_CLASSES = (set(string.ascii_lowercase), set(string.ascii_uppercase), set(string.digits), set(PASSWORD_SPECIALS))
 
 def strong_password() -> str:
-    specials = "!@#$%^&*()-_=+[]{}"
-    all_chars = string.ascii_letters + string.digits + specials
-    pw = [random.choice(string.ascii_lowercase), random.choice(string.ascii_uppercase),
-          random.choice(string.digits), random.choice(specials)]
-    pw += [secrets.choice(all_chars) for _ in range(12)]
-    random.shuffle(pw)
-    return "".join(pw)
+    """16 chars from one secrets draw; redrawn until every character class is present."""
+    n = len(PASSWORD_ALPHABET)
+    while True:
+        raw = secrets.token_bytes(2 * PASSWORD_LENGTH)
+        chars = [PASSWORD_ALPHABET[b % n] for b in raw if b < _PASSWORD_BYTE_LIMIT][:PASSWORD_LENGTH]
+        if len(chars) == PASSWORD_LENGTH and all(not cls.isdisjoint(chars) for cls in _PASSWORD_CLASSES):
+            return "".join(chars)
 
 def ws_post(function: str, form: List[Tuple[str, str | int]]):
     params = {"wstoken": MOODLE_TOKEN, "wsfunction": function, "moodlewsrestformat": "json"}
-    r = requests.post(MOODLE_URL, params=params, data=form, timeout=30)
+    body = urlencode(form) if MOODLE_GZIP_REQUESTS else ""
+    if len(body) >= GZIP_MIN_BYTES:
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Content-Encoding": "gzip"}
+        r = SESSION.post(MOODLE_URL, params=params, data=gzip.compress(body.encode("ascii")),
+                         headers=headers, timeout=30)
+    else:
+        r = SESSION.post(MOODLE_URL, params=params, data=form, timeout=30)
     r.raise_for_status()
     return r.json()
 
+# (field, value.lower()) -> matching user records. Only hits are cached: an account created
+# outside this app (or by another job) must not look missing until the entry expires.
+_USER_CACHE: TTLCache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+_USER_CACHE_LOCK = Lock()
+
 def moodle_get_users_by_field(field: str, values: List[str]) -> List[dict]:
-    form = [("field", field)] + [(f"values[{i}]", v) for i, v in enumerate(values)]
-    try:
-        data = ws_post(WS_GET_USERS_BY_FIELD, form)
-        return data if isinstance(data, list) else []
-    except requests.RequestException:
-        return []
+    out: List[dict] = []
+    misses: List[str] = []
+    with _USER_CACHE_LOCK:
+        for v in dict.fromkeys(values):
+            hit = _USER_CACHE.get((field, str(v).lower()))
+            if hit is None: misses.append(v)
+            else: out.extend(hit)
+    for start in range(0, len(misses), WS_VALUES_CHUNK):
+        chunk = misses[start:start + WS_VALUES_CHUNK]
+        form = [("field", field)] + [(f"values[{i}]", v) for i, v in enumerate(chunk)]
+        try:
+            data = ws_post(WS_GET_USERS_BY_FIELD, form)
+        except requests.RequestException:
+            continue
+        if not isinstance(data, list): continue
+        found: dict[str, List[dict]] = {}
+        for x in data:
+            if isinstance(x, dict):
+                found.setdefault(str(x.get(field, "")).lower(), []).append(x)
+                out.append(x)
+        with _USER_CACHE_LOCK:
+            for key, users in found.items():
+                _USER_CACHE[(field, key)] = users
+    return out
+
+def forget_cached_user(user: dict):
+    """Drop cached lookups for a user this app just created or changed."""
+    with _USER_CACHE_LOCK:
+        for field in ("username", "email"):
+            _USER_CACHE.pop((field, str(user.get(field) or "").lower()), None)
 
 def moodle_username_exists(username: str) -> bool:
     try:
@@ -175,12 +274,27 @@ def moodle_username_exists(username: str) -> bool:
     except Exception:
         return True  # conservative
 
-def next_available_username(base: str, used_local: set[str]) -> Tuple[str, Optional[str]]:
+def username_candidates(base: str) -> List[str]:
+    return [base] + [f"{base}{i}" for i in range(1, USERNAME_PREFETCH_SUFFIXES + 1)]
+
+def moodle_existing_usernames(bases: List[str]) -> Tuple[set[str], set[str]]:
+    """One (chunked) lookup for every likely candidate; returns (checked, existing)."""
+    checked = {c for b in bases for c in username_candidates(b)}
+    res = moodle_get_users_by_field("username", sorted(checked))
+    existing = {str(x.get("username", "")).lower() for x in res if isinstance(x, dict)}
+    return checked, existing
+
+def next_available_username(base: str, used_local: set[str], checked: set[str],
+                            remote: set[str]) -> Tuple[str, Optional[str]]:
     suffix = 0
     candidate = base
     while True:
         conflict_local = candidate in used_local
-        conflict_remote = moodle_username_exists(candidate)
+        if candidate not in checked:
+            # Beyond the prefetched range: fall back to a single remote check
+            checked.add(candidate)
+            if moodle_username_exists(candidate): remote.add(candidate)
+        conflict_remote = candidate in remote
         if not conflict_local and not conflict_remote:
             note = None if suffix == 0 else f"username adjusted to '{candidate}' (base '{base}' exists)"
             return candidate, note
@@ -188,7 +302,7 @@ def next_available_username(base: str, used_local: set[str]) -> Tuple[str, Optio
         candidate = f"{base}{suffix}"
 
 def parse_course_ids(value: str) -> List[int]:
-    ids = [int(x) for x in re.findall(r"\d+", value or "")]
+    ids = [int(x) for x in _DIGITS_RE.findall(value or "")]
     seen, out = set(), []
     for cid in ids:
         if cid not in seen:
@@ -196,32 +310,63 @@ def parse_course_ids(value: str) -> List[int]:
             out.append(cid)
     return out
 
-def is_user_enrolled(userid: int, courseid: int) -> bool:
+def moodle_user_course_ids(userid: int) -> set[int]:
+    """Ids of every course the user is enrolled in, by any method; empty if the lookup fails."""
     try:
         data = ws_post(WS_GET_USER_COURSES, [("userid", userid)])
         if isinstance(data, list):
-            return any(int(c.get("id", -1)) == int(courseid) for c in data if isinstance(c, dict))
-        return False
+            return {int(c["id"]) for c in data if isinstance(c, dict) and c.get("id") is not None}
+        return set()
     except Exception:
-        return False
+        return set()
+
+def _enrol_outcome(data) -> str:
+    # enrol_manual_enrol_users returns null on success. It also succeeds for users who are already
+    # enrolled, but then resets the enrolment dates and assigns the role again, so callers filter
+    # those out first with moodle_user_course_ids()
+    if isinstance(data, dict) and data.get("exception"):
+        msg = data.get("message","exception"); ec = data.get("errorcode",""); dbg = data.get("debuginfo")
+        return f"❌ {ec}: {msg}" + (f" — {dbg}" if dbg else "")
+    return "🎓 Enrolled"
 
 def enrol_user(userid: int, courseid: int, roleid: int = MOODLE_ROLE_ID) -> str:
-    if is_user_enrolled(userid, courseid):
-        return "Already enrolled"
     form = [
         ("enrolments[0][roleid]", roleid),
         ("enrolments[0][userid]", userid),
         ("enrolments[0][courseid]", courseid),
     ]
     try:
-        data = ws_post(WS_ENROL_MANUAL, form)
-        if isinstance(data, dict) and data.get("exception"):
-            msg = data.get("message","exception"); ec = data.get("errorcode",""); dbg = data.get("debuginfo")
-            return f"❌ {ec}: {msg}" + (f" — {dbg}" if dbg else "")
-        return "🎓 Enrolled"
+        return _enrol_outcome(ws_post(WS_ENROL_MANUAL, form))
     except requests.RequestException as e:
         return f"❌ Enrol request error: {e}"
 
+def enrol_users_batch(pairs: List[Tuple[int, int]], roleid: int = MOODLE_ROLE_ID) -> List[str]:
+    """Enrol (userid, courseid) pairs in chunked calls; returns one status per pair, in order."""
+    out: List[str] = []
+    for start in range(0, len(pairs), WS_ENROL_CHUNK):
+        chunk = pairs[start:start + WS_ENROL_CHUNK]
+        form: List[Tuple[str, str | int]] = []
+        for i, (userid, courseid) in enumerate(chunk):
+            form += [
+                (f"enrolments[{i}][roleid]", roleid),
+                (f"enrolments[{i}][userid]", userid),
+                (f"enrolments[{i}][courseid]", courseid),
+            ]
+        try:
+            data = ws_post(WS_ENROL_MANUAL, form)
+        except requests.RequestException as e:
+            out += [f"❌ Enrol request error: {e}"] * len(chunk)
+            continue
+        if isinstance(data, dict) and data.get("exception"):
+            if len(chunk) > 1:
+                # Moodle rolls back the whole call on the first bad enrolment; redo one by one to attribute it
+                out += [enrol_user(userid, courseid, roleid) for userid, courseid in chunk]
+            else:
+                out.append(_enrol_outcome(data))
+            continue
+        out += [_enrol_outcome(data)] * len(chunk)
+    return out
+
 def unsuspend_user_if_needed(user_record: dict) -> str:
     try:
         suspended = user_record.get("suspended", 0)
@@ -235,28 +380,32 @@ def unsuspend_user_if_needed(user_record: dict) -> str:
             if isinstance(data, dict) and data.get("exception"):
                 msg = data.get("message","exception"); ec = data.get("errorcode",""); dbg = data.get("debuginfo")
                 return f"❌ Unsuspend failed: {ec}: {msg}" + (f" — {dbg}" if dbg else "")
+            forget_cached_user(user_record)
             return "Unsuspended"
         except requests.RequestException as e:
             return f"❌ Unsuspend request error: {e}"
     else:
         return "Active"
 
-def _attempt_create_single(u: dict, variant: int) -> tuple[bool, str, Optional[int]]:
-    base = [
-        ("users[0][username]",  u["Username"]),
-        ("users[0][firstname]", u["First Name"]),
-        ("users[0][lastname]",  u["Last Name"]),
-        ("users[0][email]",     u["Email Address"]),
+def _create_user_form(i: int, u: dict, variant: int) -> List[Tuple[str, str | int]]:
+    form: List[Tuple[str, str | int]] = [
+        (f"users[{i}][username]",  u["Username"]),
+        (f"users[{i}][firstname]", u["First Name"]),
+        (f"users[{i}][lastname]",  u["Last Name"]),
+        (f"users[{i}][email]",     u["Email Address"]),
     ]
-    form = list(base)
     if variant in (1, 2):
-        form.append(("users[0][createpassword]", 1))
+        form.append((f"users[{i}][createpassword]", 1))
     else:
         pw = strong_password()
         u["Password"] = pw
-        form.append(("users[0][password]", pw))
+        form.append((f"users[{i}][password]", pw))
     if variant in (1, 3):
-        form.append(("users[0][auth]", "manual"))
+        form.append((f"users[{i}][auth]", "manual"))
+    return form
+
+def _attempt_create_single(u: dict, variant: int) -> tuple[bool, str, Optional[int]]:
+    form = _create_user_form(0, u, variant)
     try:
         data = ws_post(WS_CREATE_USERS, form)
         if isinstance(data, list) and data and isinstance(data[0], dict) and "id" in data[0]:
@@ -270,121 +419,326 @@ def _attempt_create_single(u: dict, variant: int) -> tuple[bool, str, Optional[i
     except requests.RequestException as e:
         return False, f"❌ Network error: {e} [variant {variant}]", None
 
+def _attempt_create_batch(users: List[dict], variant: int) -> List[tuple[bool, str, Optional[int]]]:
+    """Create several users in one call; returns one (ok, message, id) per user, in order."""
+    if len(users) == 1:
+        return [_attempt_create_single(users[0], variant)]
+    form: List[Tuple[str, str | int]] = []
+    for i, u in enumerate(users):
+        form += _create_user_form(i, u, variant)
+    try:
+        data = ws_post(WS_CREATE_USERS, form)
+    except requests.RequestException as e:
+        return [(False, f"❌ Network error: {e} [variant {variant}]", None)] * len(users)
+    if (isinstance(data, list) and len(data) == len(users)
+            and all(isinstance(x, dict) and "id" in x for x in data)):
+        suffix = " (password emailed by Moodle)" if variant in (1,2) else ""
+        return [(True, f"✅ Created (id={x['id']}) via variant {variant}{suffix}", int(x["id"])) for x in data]
+    # Moodle creates all-or-nothing: retry one by one so each row gets its own outcome
+    return [_attempt_create_single(u, variant) for u in users]
+
 # ---------------------------------------------------------------------
 # SSE job machinery
 # ---------------------------------------------------------------------
-JOBS: dict[str, dict] = {}  # job_id -> {"q": Queue, "done": bool, "result_rows": list}
-
-def sse(event: str, payload: dict) -> str:
+JOBS: dict[str, dict] = {}  # job_id -> {"events": JobEvents, "done": bool, "done_at": float, "result_rows": list}
+JOB_EVENTS_SIZE = 2048   # SSE messages kept per job for (re)connecting streams
+JOB_TTL_SECONDS = 600    # finished jobs are dropped after this, fetched or not
+PIPELINE_CHUNK = 50       # rows per unit of work handed between job stages
+PIPELINE_QUEUE_SIZE = 64  # chunks buffered between two stages
+_STOP = object()          # pipeline sentinel
+
+# Process-wide pools keep the thread count fixed no matter how many jobs are started.
+# A job thread waits on its pipeline stages (check + create + enrol workers on STAGE_EXECUTOR),
+# and the check stage waits on WS_EXECUTOR futures. STAGE_EXECUTOR fits every stage of MAX_JOBS
+# jobs at once, so a stage blocked on its queue never holds a thread another stage needs; WS tasks
+# never submit work. Nothing can deadlock.
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_JOBS, thread_name_prefix="moodle-job")
+STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_JOBS * (1 + 2 * PIPELINE_WORKERS), thread_name_prefix="moodle-stage")
+WS_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="moodle-ws")
+
+def sse(event: str, payload: dict, event_id: Optional[int] = None) -> str:
     """Pack an SSE message."""
-    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def row_payload(idx: int, u: dict) -> dict:
+    """row_update payload (a copy, so the row can keep changing in its worker thread)."""
+    return {"index": idx, "row": dict(u)}
+
+class JobEvents:
+    """Ring buffer of a job's SSE messages. Each stream tracks its own position (the SSE id),
+    so a reconnecting EventSource resumes from Last-Event-ID instead of starting over."""
+
+    def __init__(self, maxlen: int = JOB_EVENTS_SIZE):
+        self._buf: deque[Tuple[int, str, str]] = deque(maxlen=maxlen)  # (seq, event, message)
+        self._cond = Condition()
+        self.last_seq = 0
+        self.closed = False
+
+    def emit(self, event: str, payload: dict):
+        with self._cond:
+            if event == "progress" and self._buf and self._buf[-1][1] == "progress":
+                self._buf.pop()  # superseded before anyone needed it
+            self.last_seq += 1
+            self._buf.append((self.last_seq, event, sse(event, payload, self.last_seq)))
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read_after(self, seq: int, timeout: float) -> List[Tuple[int, str]]:
+        """Messages newer than seq (waiting up to timeout for one); only the newest progress is kept."""
+        with self._cond:
+            if self.last_seq <= seq and not self.closed:
+                self._cond.wait(timeout)
+            newer = []
+            for item in reversed(self._buf):
+                if item[0] <= seq: break
+                newer.append(item)
+        out, seen_progress = [], False
+        for item_seq, event, msg in newer:  # newest first
+            if event == "progress":
+                if seen_progress: continue
+                seen_progress = True
+            out.append((item_seq, msg))
+        out.reverse()
+        return out
+
+def _sweep_jobs():
+    while True:
+        time.sleep(60)
+        cutoff = time.monotonic() - JOB_TTL_SECONDS
+        for job_id, job in list(JOBS.items()):
+            if job["done"] and job.get("done_at", cutoff) < cutoff:
+                JOBS.pop(job_id, None)
+
+Thread(target=_sweep_jobs, daemon=True, name="job-sweeper").start()
+
+def run_pipeline(items: Iterable, stages: List[Tuple[Callable[[Any], None], int]]):
+    """Push items through stages of (fn, worker count) linked by bounded queues, so a later
+    stage starts on the first item while earlier stages are still busy. Returns when drained.
+    Workers run on STAGE_EXECUTOR, which is sized for _process_job's stages."""
+    queues: List[Queue] = [Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in stages]
+
+    def worker(i: int):
+        fn, inq = stages[i][0], queues[i]
+        outq = queues[i + 1] if i + 1 < len(queues) else None
+        while True:
+            item = inq.get()
+            if item is _STOP: break
+            try:
+                fn(item)
+            except Exception:
+                app.logger.exception("Pipeline stage %s failed", fn.__name__)
+            if outq is not None: outq.put(item)
+
+    workers = [[STAGE_EXECUTOR.submit(worker, i) for _ in range(max(1, n))] for i, (_, n) in enumerate(stages)]
+    for item in items:
+        queues[0].put(item)
+    # Stop stages in order: a stage's sentinels go in only after everything upstream has been passed on
+    for q, stage_workers in zip(queues, workers):
+        for _ in stage_workers: q.put(_STOP)
+        for fut in stage_workers: fut.result()
 
 def _process_job(job_id: str, rows_in: List[dict]):
-    q: Queue = JOBS[job_id]["q"]
+    job = JOBS[job_id]
+    events: JobEvents = job["events"]
 
-    # Prepare rows (validate + auto-rename baseline)
+    # Prepare rows (validate + auto-rename baseline). Per-row working state lives in lists
+    # indexed like rows, so row dicts only ever hold the columns that go back to the client.
     rows = []
+    email_keys: List[str] = []         # stripped + lowercased; used for the existing-user lookup
+    rename_notes: List[Optional[str]] = []
     for u in rows_in:
         u = {**u}
         u["Username"] = (u.get("Username") or "").lower()
         u["Enrol Status"] = u.get("Enrol Status","")
         u["Suspend Status"] = u.get("Suspend Status","")
-        u["_rename_note"] = None
-        err = validate_row(u)
+        err, (_, _, _, em) = validate_row(u)
+        email_keys.append(em)
+        rename_notes.append(None)
         if err:
             u["Status"] = f"❌ Client-side validation: {err}"
         rows.append(u)
 
-    # Auto-fix local+remote username duplicates (simple local uniqueness now; remote check when needed)
-    used_local: set[str] = set()
-    if AUTO_FIX_USERNAME_DUPLICATES:
-        for u in rows:
-            if u.get("Status"): continue
-            base = u["Username"]
-            cand, note = next_available_username(base, used_local)
-            used_local.add(cand)
-            if cand != base:
-                u["Username"] = cand
-                u["_rename_note"] = note
-
-    # Prefetch existing by email once (stream stage)
-    emails_to_check = [u["Email Address"] for u in rows if not u.get("Status")]
-    q.put(sse("stage", {"message": f"Checking {len(emails_to_check)} emails on Moodle…"}))
-    existing_list = moodle_get_users_by_field("email", emails_to_check)
-    existing_by_email = {str(x.get("email","")).lower(): x for x in existing_list if isinstance(x, dict)}
-
     total = len(rows)
+    unresolved = object()
+    user_ids: List[Any] = [unresolved] * total  # Moodle id, None if unknown; unresolved = row failed earlier
+    enrolled_courses: List[set[int]] = [set()] * total  # existing users only; new users have none
     processed = 0
+    progress_step = max(1, total // 200)
+    last_progress_ts = time.monotonic()
+    progress_lock = Lock()
 
-    # Process each row
-    for idx, u in enumerate(rows):
+    def finish(idx: int):
+        nonlocal processed, last_progress_ts
+        # Push a row_update event so UI can update table incrementally
+        events.emit("row_update", row_payload(idx, rows[idx]))
+
+        # Progress %, at most ~200 steps or 10 updates/s (always the last row)
+        with progress_lock:
+            processed += 1
+            now = time.monotonic()
+            if processed % progress_step == 0 or now - last_progress_ts >= 0.1 or processed == total:
+                last_progress_ts = now
+                pct = int(processed * 100 / max(total, 1))
+                events.emit("progress", {"processed": processed, "total": total, "percent": pct})
+
+    # ---- Stage 1: usernames + existing accounts (single worker: it owns used_local) ----
+    used_local: set[str] = set()
+
+    def check(chunk: dict):
+        idxs = chunk["rows"]
         try:
-            if u.get("Status"):
-                # Already invalid earlier
-                pass
-            else:
-                # Determine course ids for this user
+            # Auto-fix local+remote username duplicates
+            if AUTO_FIX_USERNAME_DUPLICATES:
+                checked, remote_usernames = moodle_existing_usernames(list({rows[i]["Username"] for i in idxs}))
+                for i in idxs:
+                    u = rows[i]
+                    base = u["Username"]
+                    cand, note = next_available_username(base, used_local, checked, remote_usernames)
+                    used_local.add(cand)
+                    if cand != base:
+                        u["Username"] = cand
+                        rename_notes[i] = note
+
+            existing_list = moodle_get_users_by_field("email", [email_keys[i] for i in idxs])
+            existing_by_email = {str(x.get("email","")).lower(): x for x in existing_list if isinstance(x, dict)}
+        except Exception as e:
+            for i in idxs: rows[i]["Status"] = f"❌ Server error: {e}"
+            return
+
+        # Existing accounts: fill details, unsuspend and fetch their courses; the rest go to the create stage
+        unsuspend_futs, courses_futs = {}, {}
+        for idx in idxs:
+            u = rows[idx]
+            try:
+                existing = existing_by_email.get(email_keys[idx])
+                if not existing:
+                    chunk["create"].append(idx)
+                    continue
+                u["Existing First Name"] = existing.get("firstname","") or ""
+                u["Existing Last Name"]  = existing.get("lastname","")  or ""
+                u["Existing Username"]   = existing.get("username","")  or ""
+                u["Existing Email"]      = existing.get("email","")     or ""
+                u["Existing ID"]         = str(existing.get("id","") or "")
+                u["Status"] = "already exist"
+                unsuspend_futs[WS_EXECUTOR.submit(unsuspend_user_if_needed, existing)] = idx
+                try:
+                    user_ids[idx] = int(existing.get("id"))
+                except Exception:
+                    user_ids[idx] = None
+                if user_ids[idx] is not None and (u.get("Course IDs") or "").strip():
+                    courses_futs[WS_EXECUTOR.submit(moodle_user_course_ids, user_ids[idx])] = idx
+            except Exception as e:
+                u["Status"] = f"❌ Server error: {e}"
+        for fut in as_completed(unsuspend_futs):
+            u = rows[unsuspend_futs[fut]]
+            try:
+                u["Suspend Status"] = fut.result()
+            except Exception as e:
+                u["Status"] = f"❌ Server error: {e}"
+                user_ids[unsuspend_futs[fut]] = unresolved
+        for fut in as_completed(courses_futs):
+            enrolled_courses[courses_futs[fut]] = fut.result()
+
+    # ---- Stage 2: create new accounts; rows failing a variant are retried together with the next one ----
+    def create(chunk: dict):
+        remaining = chunk["create"]
+        for variant in (1, 2, 3, 4):
+            if not remaining: break
+            failed: List[int] = []
+            for start in range(0, len(remaining), WS_CREATE_CHUNK):
+                part = remaining[start:start + WS_CREATE_CHUNK]
+                try:
+                    results = _attempt_create_batch([rows[i] for i in part], variant)
+                except Exception as e:
+                    results = [(False, f"❌ Server error: {e}", None)] * len(part)
+                for idx, (ok, msg, uid) in zip(part, results):
+                    u = rows[idx]
+                    if not ok:
+                        u["Status"] = msg or "❌ Unknown outcome"
+                        failed.append(idx)
+                        continue
+                    if rename_notes[idx]:
+                        msg = f"{msg} — {rename_notes[idx]}"
+                    u["Status"] = msg
+                    u["Suspend Status"] = "Active"
+                    user_ids[idx] = uid
+                    forget_cached_user({"username": u["Username"], "email": u["Email Address"]})
+                    events.emit("row_update", row_payload(idx, u))
+            remaining = failed
+        for idx in remaining:
+            user_ids[idx] = None  # every variant failed; Status holds the last error
+
+    # ---- Stage 3: batch enrolments, then each row is final ----
+    def enrol(chunk: dict):
+        pending: List[Tuple[int, int, int, int]] = []  # (row index, position in its messages, userid, courseid)
+        enrol_msgs: dict[int, List[str]] = {}
+        try:
+            for idx in chunk["rows"]:
+                u = rows[idx]
+                if user_ids[idx] is unresolved:
+                    continue  # failed earlier
                 course_ids = parse_course_ids((u.get("Course IDs") or "").strip())
-                enrol_msgs: List[str] = []
-                existing = existing_by_email.get(u["Email Address"].lower())
-                user_id_for_actions: Optional[int] = None
-
-                if existing:
-                    # Fill existing details + unsuspend
-                    u["Existing First Name"] = existing.get("firstname","") or ""
-                    u["Existing Last Name"]  = existing.get("lastname","")  or ""
-                    u["Existing Username"]   = existing.get("username","")  or ""
-                    u["Existing Email"]      = existing.get("email","")     or ""
-                    u["Existing ID"]         = str(existing.get("id","") or "")
-                    u["Status"] = "already exist"
-                    u["Suspend Status"] = unsuspend_user_if_needed(existing)
-                    try:
-                        user_id_for_actions = int(existing.get("id"))
-                    except Exception:
-                        user_id_for_actions = None
-                else:
-                    # Create (variants)
-                    created_ok, msg, created_id = False, "", None
-                    for variant in (1, 2, 3, 4):
-                        ok, m, uid = _attempt_create_single(u, variant)
-                        created_ok, msg, created_id = ok, m, uid
-                        if ok: break
-                    if created_ok and u.get("_rename_note"):
-                        msg = f"{msg} — {u['_rename_note']}"
-                    u["Status"] = msg or "❌ Unknown outcome"
-                    user_id_for_actions = created_id
-                    u["Suspend Status"] = "Active" if created_ok else (u["Suspend Status"] or "")
-
-                # Enrol
                 if not course_ids:
-                    enrol_msgs.append("No course id provided")
-                elif user_id_for_actions is None:
-                    enrol_msgs.append("❌ No user id for enrolment")
+                    enrol_msgs[idx] = ["No course id provided"]
+                elif user_ids[idx] is None:
+                    enrol_msgs[idx] = ["❌ No user id for enrolment"]
                 else:
+                    # Re-enrolling would reset the enrolment dates and re-assign the role, so skip those
+                    msgs = enrol_msgs[idx] = []
                     for cid in course_ids:
-                        enrol_msgs.append(f"{cid}: {enrol_user(user_id_for_actions, cid, MOODLE_ROLE_ID)}")
-
-                u["Enrol Status"] = " | ".join(enrol_msgs) if enrol_msgs else u.get("Enrol Status","")
-
-        except Exception as e:
-            u["Status"] = f"❌ Server error: {e}"
-
+                        if cid in enrolled_courses[idx]:
+                            msgs.append(f"{cid}: Already enrolled")
+                        else:
+                            pending.append((idx, len(msgs), user_ids[idx], cid))
+                            msgs.append("")
+            if pending:
+                try:
+                    results = enrol_users_batch([(uid, cid) for _, _, uid, cid in pending], MOODLE_ROLE_ID)
+                except Exception as e:
+                    results = [f"❌ Server error: {e}"] * len(pending)
+                for (idx, pos, _, cid), res in zip(pending, results):
+                    enrol_msgs[idx][pos] = f"{cid}: {res}"
+            for idx, msgs in enrol_msgs.items():
+                rows[idx]["Enrol Status"] = " | ".join(msgs)
         finally:
-            u.pop("_rename_note", None)
-            # Push a row_update event so UI can update table incrementally
-            q.put(sse("row_update", {"index": idx, "row": u}))
+            for idx in chunk["rows"]:
+                finish(idx)
 
-            # Progress %
-            processed += 1
-            pct = int(processed * 100 / max(total, 1))
-            q.put(sse("progress", {"processed": processed, "total": total, "percent": pct}))
+    # Invalid rows are final straight away; the rest flow through check → create → enrol in chunks
+    valid = []
+    for idx, u in enumerate(rows):
+        if u.get("Status"): finish(idx)
+        else: valid.append(idx)
+    events.emit("stage", {"message": f"Checking {len(valid)} emails on Moodle…"})
+    chunks = ({"rows": valid[i:i + PIPELINE_CHUNK], "create": []} for i in range(0, len(valid), PIPELINE_CHUNK))
+    run_pipeline(chunks, [(check, 1), (create, PIPELINE_WORKERS), (enrol, PIPELINE_WORKERS)])
 
     # All done
-    JOBS[job_id]["result_rows"] = rows
-    JOBS[job_id]["done"] = True
-    q.put(sse("done", {"percent": 100, "total": total}))
-    # Close stream by sending a sentinel comment (some proxies like a final newline)
-    q.put(":\n\n")
+    job["result_rows"] = rows
+    job["done_at"] = time.monotonic()
+    job["done"] = True
+    events.emit("done", {"percent": 100, "total": total})
+    events.close()
+
+def _run_job(job_id: str, rows_in: List[dict]):
+    # Pool threads keep exceptions in the future; log them like a plain Thread would
+    try:
+        _process_job(job_id, rows_in)
+    except Exception as e:
+        app.logger.exception("Moodle job %s failed", job_id)
+        job = JOBS.get(job_id)
+        if job:
+            job["events"].emit("stage", {"message": f"❌ Server error: {e}"})
+            job["done_at"] = time.monotonic()
+            job["done"] = True
+            # The client only resets on "done"; without it the page stays on "Processing…"
+            job["events"].emit("done", {"percent": 100, "total": len(rows_in), "error": str(e)})
+            job["events"].close()
 
 # ---------------------------------------------------------------------
 # Routes: UI + basic endpoints
@@ -398,7 +752,7 @@ def api_ping():
     if not MOODLE_URL or not MOODLE_TOKEN:
         return {"ok": False, "error": "Missing MOODLE_URL or MOODLE_TOKEN on server"}, 400
     try:
-        r = requests.get(MOODLE_URL, params={
+        r = SESSION.get(MOODLE_URL, params={
             "wstoken": MOODLE_TOKEN, "wsfunction": WS_GET_SITE_INFO, "moodlewsrestformat": "json"
         }, timeout=15)
         r.raise_for_status()
@@ -413,9 +767,10 @@ def api_ping():
 def api_preview():
     try:
         if "file" not in request.files: return {"error": "Missing file"}, 400
-        text = request.files["file"].read().decode("utf-8-sig", errors="replace")
-        rows = list(csv.DictReader(io.StringIO(text)))
-        out = make_usernames(rows)
+        # Decode the upload incrementally instead of reading it into one string first. Lines are
+        # split on b"\n" only; a text reader's splitlines() would also break on \x0c, \x85, U+2028…
+        stream = codecs.iterdecode(request.files["file"].stream, "utf-8-sig", errors="replace")
+        out = list(make_usernames(csv.DictReader(stream)))
         return jsonify({"rows": out, "count": len(out)})
     except ValueError as e:
         return {"error": str(e)}, 400
@@ -433,9 +788,13 @@ def api_moodle_start():
     if not isinstance(rows, list) or not rows:
         return {"error": "Invalid or empty 'rows'"}, 400
     job_id = uuid.uuid4().hex
-    JOBS[job_id] = {"q": Queue(), "done": False, "result_rows": []}
-    t = Thread(target=_process_job, args=(job_id, rows), daemon=True)
-    t.start()
+    events = JobEvents()
+    busy = sum(1 for j in list(JOBS.values()) if not j["done"])
+    if busy >= MAX_JOBS:
+        # Every JOB_EXECUTOR slot is taken; say so instead of leaving the UI on "Processing…"
+        events.emit("stage", {"message": f"Queued behind {busy - MAX_JOBS + 1} other job(s)…"})
+    JOBS[job_id] = {"events": events, "done": False, "result_rows": []}
+    JOB_EXECUTOR.submit(_run_job, job_id, rows)
     return {"job_id": job_id}
 
 @app.get("/api/moodle/stream/<job_id>")
@@ -443,25 +802,30 @@ def api_moodle_stream(job_id):
     """SSE stream for a given job_id."""
     if job_id not in JOBS:
         return {"error": "Unknown job"}, 404
-    q: Queue = JOBS[job_id]["q"]
+    job = JOBS[job_id]  # keep a reference; /result may drop the entry once done
+    events: JobEvents = job["events"]
+    try:
+        last_id = int(request.headers.get("Last-Event-ID", "0"))  # sent by EventSource on reconnect
+    except ValueError:
+        last_id = 0
 
     @stream_with_context
     def gen():
         # initial ping & retry hint
         yield "retry: 1500\n\n"
-        yield sse("hello", {"job_id": job_id})
+        if not last_id:
+            yield sse("hello", {"job_id": job_id})
+        seq = last_id
         while True:
-            try:
-                msg = q.get(timeout=25)
+            batch = events.read_after(seq, timeout=25)
+            for seq, msg in batch:
                 yield msg
-                # stop if job is done and queue drained
-                if JOBS[job_id]["done"] and q.empty():
-                    break
-            except Empty:
+            # stop once the job is done and this client has everything
+            if events.closed and seq >= events.last_seq:
+                break
+            if not batch:
                 # keep-alive comment
                 yield ":\n\n"
-        # optional: cleanup
-        # del JOBS[job_id]  # uncomment if you don't need /result after done
 
     headers = {
         "Content-Type": "text/event-stream",
@@ -473,23 +837,25 @@ def api_moodle_stream(job_id):
 
 @app.get("/api/moodle/result/<job_id>")
 def api_moodle_result(job_id):
-    """Fetch final rows for a job (after done)."""
-    if job_id not in JOBS:
+    """Fetch final rows for a job (after done); the job is forgotten once they've been handed out."""
+    job = JOBS.get(job_id)
+    if job is None:
         return {"error": "Unknown job"}, 404
-    return {"rows": JOBS[job_id].get("result_rows", [])}
+    if job["done"]:
+        JOBS.pop(job_id, None)
+    return {"rows": job.get("result_rows", [])}
 
-# Non-stream (download) remains the same
+# CSV download, streamed in chunks as it is written
 @app.post("/api/download")
 def api_download():
     try:
         data = request.get_json(silent=True) or {}
         rows = data.get("rows", [])
-        if not isinstance(rows, list) or not rows:
+        if not isinstance(rows, list) or not rows or not all(isinstance(r, dict) for r in rows):
             return {"error": "Invalid or empty 'rows'"}, 400
-        csv_bytes = rows_to_csv_bytes(rows)
-        return send_file(io.BytesIO(csv_bytes), mimetype="text/csv; charset=utf-8",
-                         as_attachment=True,
-                         download_name=f"usernames_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv")
+        name = f"usernames_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv"
+        return Response(iter_csv_bytes(rows), content_type="text/csv; charset=utf-8",
+                        headers={"Content-Disposition": f"attachment; filename={name}"})
     except Exception as e:
         return {"error": f"Server error: {e}"}, 500
 